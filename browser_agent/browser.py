@@ -1,8 +1,9 @@
 import logging
+import os
 import re
 import asyncio
 import time
-import aiofiles
+from google.adk.tools.tool_context import ToolContext
 from google.genai import types
 from typing import Any, Dict, List, Literal, Optional
 from playwright.async_api import TimeoutError as PlaywrightTimeoutError
@@ -10,10 +11,296 @@ from playwright.async_api import async_playwright
 
 from browser_agent.dom_retriever import DOMRetriever
 
+_POINT_RE = re.compile(r"-?\d+")
+_MODIFIER_KEYS = frozenset({"Control", "Shift", "Alt"})
+# Selector actions first try this long, so a selector that matches nothing fails fast;
+# a match that is only not actionable yet gets the rest of the timeout
+_FIRST_ATTEMPT_MS = 3000
+
+# Blocked when disable_resources is set. Images and stylesheets are kept: the
+# agent reasons over screenshots and the extractor relies on computed styles.
+_BLOCKED_RESOURCE_TYPES = frozenset({"font", "media", "texttrack", "manifest"})
+
+# With dom_diff, at most this many added + removed elements are sent as a diff
+# instead of the full element list
+_DOM_DIFF_THRESHOLD = 3
+
+_IDLE_JS = "() => new Promise(r => requestIdleCallback(r, { timeout: 500 }))"
+
+# Page-side helpers. They are installed once per context with add_init_script
+# (see _INIT_SCRIPT) so hot-path evaluate calls only ship a short call
+# expression instead of re-sending and re-parsing the whole source.
+_EXTRACT_INTERACTIVE_JS = """
+    ({limit, viewportOnly}) => {
+    // clickable tags, inline handlers and interactive ARIA roles; cursor:pointer is left out,
+    // it would need a computed style for every node in the document
+    const els = document.querySelectorAll(
+        'a, button, input, textarea, select, summary, [onclick], ' +
+        '[role="button"], [role="link"], [role="checkbox"], [role="radio"], [role="switch"], ' +
+        '[role="tab"], [role="menuitem"], [role="option"]'
+    );
+
+    const clean = (s) => (s || '').replace(/\\s+/g, ' ').trim(); // normalize whitespace
+
+    const getText = (el) => {
+        const aria = el.getAttribute("aria-label");
+        if (aria) return aria;
+
+        const tag = el.tagName.toLowerCase();
+
+        if (tag === "input" || tag === "textarea") {
+        const type = (el.getAttribute("type") || "").toLowerCase();
+        const ph = el.getAttribute("placeholder") || "";
+        if (type === "password") return ph;
+        return ph || el.value || "";
+        }
+
+        if (tag === "select") {
+        const opt = el.selectedOptions && el.selectedOptions[0];
+        return (opt && opt.textContent) || "";
+        }
+
+        // textContent needs no layout, unlike innerText; clean() collapses the whitespace
+        return el.textContent || "";
+    };
+
+    // single pass over the NodeList, stopping as soon as `limit` elements are collected
+    const out = [];
+    for (const el of els) {
+        if (out.length >= limit) break;
+
+        // cheap attribute checks first, they need no layout or style
+        if (el.hasAttribute("disabled")) continue;
+        if (el.getAttribute("aria-disabled") === "true") continue;
+        if (el.closest('[aria-hidden="true"]')) continue;
+
+        const rect = el.getBoundingClientRect();
+        if (rect.width <= 1 || rect.height <= 1) continue;
+        if (viewportOnly && (rect.bottom <= 0 || rect.right <= 0 ||
+            rect.top >= window.innerHeight || rect.left >= window.innerWidth)) continue;
+
+        const style = window.getComputedStyle(el);
+        if (!style) continue;
+        if (style.display === 'none' || style.visibility === 'hidden') continue;
+        if (style.pointerEvents === 'none') continue;
+        if (Number(style.opacity) === 0) continue;
+
+        // bound the raw text before normalizing it, textContent of large elements can be huge
+        const text = clean(getText(el).substring(0, 500)).slice(0, 100);
+
+        const tag = el.tagName.toLowerCase();
+        if (!text && !["input", "textarea", "select"].includes(tag)) continue; // filter out non-interactive elements without text
+
+        let result = `-${tag}: ${text}`;
+        
+        const attrs = [];
+        if (el.id) attrs.push(`id=${el.id}`);
+        const nameAttr = el.getAttribute("name");
+        if (nameAttr) attrs.push(`name=${nameAttr}`);
+        const ariaAttr = el.getAttribute("aria-label");
+        if (ariaAttr) attrs.push(`aria=${ariaAttr}`);
+        
+        if (attrs.length > 0) {
+            result += ` (${attrs.join(', ')})`;
+        }
+
+        out.push(result);
+    }
+
+    return out;
+    }
+"""
+
+_SCROLL_METRICS_JS = """
+    () => {
+        const scrollY = window.scrollY || window.pageYOffset;
+        const viewportH = window.innerHeight;
+        const docH = Math.max(
+            document.body.scrollHeight,
+            document.documentElement.scrollHeight,
+            document.body.offsetHeight,
+            document.documentElement.offsetHeight,
+            document.body.clientHeight,
+            document.documentElement.clientHeight
+        );
+        return {
+            scrollY,
+            viewportH,
+            docH,
+            atBottom: scrollY + viewportH >= docH - 2  // small tolerance
+        };
+    }
+"""
+
+# Everything get_state needs from the page in a single round-trip. With ``reuse``
+# the elements are only re-extracted if the DOM changed since the last call
+# (``elements: null`` tells the caller to use its cached copy).
+_STATE_BUNDLE_JS = f"""
+    (args) => {{
+        const fresh = !args.reuse || window.__domDirty !== false;
+        const elements = fresh ? ({_EXTRACT_INTERACTIVE_JS.strip()})(args) : null;
+        // only full lists are cached on the Python side, viewport-only calls must keep the flag
+        if (!args.viewportOnly && window.__domDirty !== undefined) window.__domDirty = false;
+        return {{
+            url: location.href,
+            elements,
+            metrics: ({_SCROLL_METRICS_JS.strip()})(),
+        }};
+    }}
+"""
+
+# Flags any DOM change so cached element lists can be reused until the page mutates
+_DOM_OBSERVER_JS = """
+window.__domDirty = true;
+new MutationObserver(() => { window.__domDirty = true; }).observe(document, {
+    subtree: true, childList: true, attributes: true, characterData: true
+});
+// stylesheets and images finishing after DOMContentLoaded change sizes and styles without mutations
+window.addEventListener("load", () => { window.__domDirty = true; });
+"""
+
+_FIND_TEXT_JS = """
+    (needle) => {
+        // Single walk over text nodes: the first match's parent is the innermost element with the text
+        const skip = new Set(["SCRIPT", "STYLE", "NOSCRIPT", "TEMPLATE"]);
+        const walker = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT);
+        while (walker.nextNode()) {
+            const node = walker.currentNode;
+            const e = node.parentElement;
+            if (!e || skip.has(e.tagName)) continue;
+            if (!node.data.toLowerCase().includes(needle)) continue;
+            if (e.getClientRects().length === 0) continue; // hidden
+            e.scrollIntoView({ block: "center", behavior: "instant" });
+            return node.data.trim().slice(0, 140);
+        }
+
+        // Fallback for text split across inline elements, e.g. "<b>foo</b> bar"
+        const elems = Array.from(document.querySelectorAll("h1,h2,h3,h4,h5,h6,a,button,p,li,section,div"));
+        for (const e of elems) {
+            if (e.getClientRects().length === 0) continue; // hidden
+            // innerText (layout-bound, but only reached on a miss) leaves out script/style and hidden subtrees
+            const content = e.innerText || "";
+            if (content.toLowerCase().includes(needle)) {
+                e.scrollIntoView({ block: "center", behavior: "instant" });
+                return content.trim().slice(0, 140);
+            }
+        }
+        return null;
+    }
+"""
+
+# Resolves after the next rendered frame, bounded in case rAF is throttled
+_NEXT_FRAME_JS = """new Promise((r) => {
+            requestAnimationFrame(() => setTimeout(r, 50));
+            setTimeout(r, 300);
+        })"""
+
+# Scroll to a percent/absolute y, wait for the next frame (bounded) and return
+# before/after metrics: one round-trip instead of metrics + scroll + sleep + metrics
+_SCROLL_TO_SETTLED_JS = f"""
+    async ({{percent, y}}) => {{
+        const metrics = ({_SCROLL_METRICS_JS.strip()});
+        const before = metrics();
+        const maxTop = before.docH - before.viewportH;
+        const top = percent !== null
+            ? Math.trunc(maxTop * (percent / 100))
+            : Math.max(0, Math.min(y, maxTop));
+        window.scrollTo({{ top, left: 0, behavior: "instant" }});
+        await {_NEXT_FRAME_JS};
+        return {{ before, after: metrics() }};
+    }}
+"""
+
+# All steps of scroll(mode="step") in one round-trip, one frame between steps
+_SCROLL_STEP_SETTLED_JS = f"""
+    async ({{direction, steps}}) => {{
+        const metrics = ({_SCROLL_METRICS_JS.strip()});
+        const before = metrics();
+        const stepPx = Math.trunc(before.viewportH * 0.8);
+        const dx = direction === "right" ? stepPx : direction === "left" ? -stepPx : 0;
+        const dy = direction === "down" ? stepPx : direction === "up" ? -stepPx : 0;
+        for (let i = 0; i < steps; i++) {{
+            window.scrollBy({{ left: dx, top: dy, behavior: "instant" }});
+            await {_NEXT_FRAME_JS};
+        }}
+        return {{ before, after: metrics() }};
+    }}
+"""
+
+# Metrics once the next frame has rendered, for scrolls performed through Playwright
+_SETTLED_METRICS_JS = f"""
+    async () => {{
+        await {_NEXT_FRAME_JS};
+        return ({_SCROLL_METRICS_JS.strip()})();
+    }}
+"""
+
+# scroll(mode="to_text") in one round-trip: metrics, find + scrollIntoView, next frame, metrics.
+# Resolves to null when the text is not on the page.
+_SCROLL_TO_TEXT_SETTLED_JS = f"""
+    async (needle) => {{
+        const metrics = ({_SCROLL_METRICS_JS.strip()});
+        const before = metrics();
+        const found = ({_FIND_TEXT_JS.strip()})(needle);
+        if (!found) return null;
+        await {_NEXT_FRAME_JS};
+        return {{ before, after: metrics() }};
+    }}
+"""
+
+_TEXT_AT_POINT_JS = """
+    ({x, y}) => {
+        const el = document.elementFromPoint(x, y);
+        // bound before normalizing: a wrapper or body hit would otherwise scan the whole page
+        return el ? (el.textContent || "").substring(0, 500).replace(/\\s+/g, " ").trim().slice(0, 100) : "";
+    }
+"""
+
+_PAGE_HELPERS = {
+    "__extractInteractive": _EXTRACT_INTERACTIVE_JS,
+    "__scrollMetrics": _SCROLL_METRICS_JS,
+    "__stateBundle": _STATE_BUNDLE_JS,
+}
+
+_INIT_SCRIPT = "\n".join(
+    [f"window.{name} = {source.strip()};" for name, source in _PAGE_HELPERS.items()] + [_DOM_OBSERVER_JS.strip()]
+)
+
 
 class BrowserManager:
-    def __init__(self, show_browser: bool = True):
+    def __init__(
+        self,
+        show_browser: bool = True,
+        screenshot_quality: int = 60,
+        screenshot_type: Literal["jpeg", "png"] = "jpeg",
+        screenshot_scale: float = 1.0,
+        record_video: bool = False,
+        disable_resources: bool = False,
+        cdp_url: Optional[str] = None,
+        dom_diff: bool = False,
+        keep_alive_s: Optional[float] = 60.0,
+        wait_strategy: Literal["domcontentloaded", "load", "complete", "networkidle"] = "domcontentloaded",
+    ):
+        if not 0 < screenshot_scale <= 1:
+            raise ValueError(f"screenshot_scale must be in (0, 1], got {screenshot_scale}")
         self.show_browser = show_browser
+        self.record_video = record_video
+        self.disable_resources = disable_resources  # abort requests in _BLOCKED_RESOURCE_TYPES
+        # Attach to an already running browser instead of launching one (e.g. a long-lived
+        # `chromium --remote-debugging-port=9222`), so sessions skip the cold start
+        self.cdp_url = cdp_url or os.getenv("BROWSER_CDP_URL")
+        self.wait_strategy = wait_strategy  # load state awaited after actions
+        # Send small element changes as a diff against the previous observation of the same
+        # ADK invocation, the only one the model is guaranteed to still have in its context
+        self.dom_diff = dom_diff
+        # After close(), the browser stays up this long for a new session, then shutdown() runs.
+        # None keeps it until shutdown() is called explicitly.
+        self.keep_alive_s = keep_alive_s
+        self.screenshot_quality = screenshot_quality  # JPEG quality sent to the VLM
+        self.screenshot_type = screenshot_type  # JPEG is several times smaller than PNG for the VLM
+        # < 1 renders the page at a lower device scale factor, so screenshots come out
+        # smaller straight from Chromium's encoder; coordinate clicks are mapped back
+        self.screenshot_scale = screenshot_scale
         self.playwright = None
         self.driver = None
         self.context = None
@@ -21,6 +308,16 @@ class BrowserManager:
         self._started = False
         self._browser_lock = asyncio.Lock()
         self._page_lock = asyncio.Lock()
+        self._idle_shutdown: Optional[asyncio.TimerHandle] = None
+        # In-flight get_state captures, keyed by url + arguments, shared by identical concurrent calls
+        self._inflight_states: Dict[tuple, asyncio.Future] = {}
+        # Bumped by every page action when it is issued, part of the coalescing key
+        self._action_generation = 0
+        # (url, limit, elements) of the last extraction, reused while the DOM is unchanged.
+        # Actions reset it: typed values and focus/hover state do not show up as mutations.
+        self._dom_cache: Optional[tuple] = None
+        # (invocation_id, url, query, viewport_only, elements) of the last get_state, the base for dom_diff
+        self._last_observation: Optional[tuple] = None
 
         # RAG helper for DOM elements. We instantiate once to avoid
         # reloading the transformer on every request.
@@ -31,14 +328,32 @@ class BrowserManager:
         if self._started:
             return
 
-        self.playwright = await async_playwright().start()
-        self.driver = await self.playwright.chromium.launch(headless=not self.show_browser)
-
-        self.context = await self.driver.new_context(
-            viewport={"width": 1024, "height": 768},
-            record_video_dir="videos/",
-            record_video_size={"width": 1024, "height": 768},
-        )
+        if self._idle_shutdown is not None:
+            self._idle_shutdown.cancel()
+            self._idle_shutdown = None
+
+        # The browser process survives close(), only pay the launch the first time
+        if self.driver is None or not self.driver.is_connected():
+            if self.playwright is None:
+                self.playwright = await async_playwright().start()
+            if self.cdp_url:
+                logging.info(f"Connecting to browser over CDP: {self.cdp_url}")
+                self.driver = await self.playwright.chromium.connect_over_cdp(self.cdp_url)
+            else:
+                self.driver = await self.playwright.chromium.launch(headless=not self.show_browser)
+
+        context_kwargs = {"viewport": {"width": 1024, "height": 768}}
+        if self.screenshot_scale < 1:
+            # same CSS layout, fewer device pixels to rasterize and encode
+            context_kwargs["device_scale_factor"] = self.screenshot_scale
+        if self.record_video:
+            # Video encoding runs for the whole session, only pay for it when asked
+            context_kwargs["record_video_dir"] = "videos/"
+            context_kwargs["record_video_size"] = {"width": 1024, "height": 768}
+        self.context = await self.driver.new_context(**context_kwargs)
+        await self.context.add_init_script(script=_INIT_SCRIPT)
+        if self.disable_resources:
+            await self.context.route("**/*", self._block_resource)
 
         self.active_page = await self.context.new_page()
         self.active_page.set_default_timeout(10000)
@@ -51,6 +366,12 @@ class BrowserManager:
         
         self._started = True
 
+    async def _block_resource(self, route):
+        if route.request.resource_type in _BLOCKED_RESOURCE_TYPES:
+            await route.abort()
+        else:
+            await route.continue_()
+
     async def _ensure_started(self):
         """Lazy init: start browser on first tool call."""
         if not self._started:
@@ -59,130 +380,116 @@ class BrowserManager:
                     await self.init()
 
     async def _wait_for_load_state(self):
-        """Waits for the page to be idle after an action."""
+        """Waits for the page to be loaded after an action."""
         try:
-            await self.active_page.wait_for_load_state("networkidle", timeout=5000)
+            if self.wait_strategy == "networkidle":
+                # never settles on pages with beacons/long-polling, only for callers that need it
+                await self.active_page.wait_for_load_state("networkidle", timeout=5000)
+                return
+            if self.wait_strategy == "complete":
+                # document fully loaded (subresources included) without waiting on the network going quiet
+                await self.active_page.wait_for_function("() => document.readyState === 'complete'", timeout=2000)
+                return
+            # returns immediately if the document is already loaded
+            await self.active_page.wait_for_load_state(self.wait_strategy, timeout=2000)
+            # then give pending page scripts (e.g. client-side rendering) a bounded idle slot
+            await self.active_page.evaluate(_IDLE_JS)
         except:
             pass
 
-    def _parse_point(self, point: str):
-        # support both <point>x y</point> and HTML-escaped &lt;point&gt;x y&lt;/point&gt;
-        clean = (
-            point.replace("&lt;point&gt;", "")
-                 .replace("&lt;/point&gt;", "")
-                 .replace("<point>", "")
-                 .replace("</point>", "")
-                 .strip()
+    async def _call_page_helper(self, name: str, source: str, arg: Any = None):
+        """Calls a helper installed by _INIT_SCRIPT, shipping its source only if missing."""
+        result = await self.active_page.evaluate(
+            f"(arg) => window.{name} ? {{ value: window.{name}(arg) }} : null", arg
         )
-        numbers = re.findall(r"-?\d+", clean)
+        if result is None:
+            # e.g. a document that was already loaded before the init script was registered
+            return await self.active_page.evaluate(source, arg)
+        return result["value"]
+
+    def _parse_point(self, point: str):
+        # supports both <point>x y</point> and HTML-escaped &lt;point&gt;x y&lt;/point&gt;:
+        # the tags contain no digits, so there is nothing to strip before matching
+        numbers = _POINT_RE.findall(point)
 
         if len(numbers) < 2:
             raise ValueError(f"Invalid point format: {point}")
 
         return int(numbers[0]), int(numbers[1])
 
-    async def _extract_interactive_elements(self, limit: int = 50):
-        elements = await self.active_page.evaluate(
-            """
-            (limit) => {
-            const els = Array.from(document.querySelectorAll(
-                'a, button, input, textarea, select, [role="button"]'
-            ));
-
-            const clean = (s) => (s || '').replace(/\\s+/g, ' ').trim(); // normalize whitespace
-
-            const getText = (el) => {
-                const aria = el.getAttribute("aria-label");
-                if (aria) return aria;
-
-                const tag = el.tagName.toLowerCase();
-
-                if (tag === "input" || tag === "textarea") {
-                const type = (el.getAttribute("type") || "").toLowerCase();
-                const ph = el.getAttribute("placeholder") || "";
-                if (type === "password") return ph;
-                return ph || el.value || "";
-                }
-
-                if (tag === "select") {
-                const opt = el.selectedOptions && el.selectedOptions[0];
-                return (opt && (opt.innerText || opt.textContent)) || "";
-                }
-
-                return el.innerText || el.textContent || "";
-            };
-
-            const out = els.map((el) => {
-                const rect = el.getBoundingClientRect();
-                if (rect.width <= 1 || rect.height <= 1) return null;
-
-                const style = window.getComputedStyle(el);
-                if (!style) return null;
-                if (style.display === 'none' || style.visibility === 'hidden') return null;
-                if (style.pointerEvents === 'none') return null;
-                if (Number(style.opacity) === 0) return null;
-
-                if (el.hasAttribute("disabled")) return null;
-                if (el.getAttribute("aria-disabled") === "true") return null;
-
-                const text = clean(getText(el)).slice(0, 100);
-
-                const tag = el.tagName.toLowerCase();
-                if (!text && !["input", "textarea", "select"].includes(tag)) return null; // filter out non-interactive elements without text
-
-                let result = `-${tag}: ${text}`;
-                
-                const attrs = [];
-                if (el.id) attrs.push(`id=${el.id}`);
-                const nameAttr = el.getAttribute("name");
-                if (nameAttr) attrs.push(`name=${nameAttr}`);
-                const ariaAttr = el.getAttribute("aria-label");
-                if (ariaAttr) attrs.push(`aria=${ariaAttr}`);
-                
-                if (attrs.length > 0) {
-                    result += ` (${attrs.join(', ')})`;
-                }
-
-                return result;                
-            }).filter(Boolean);
-
-            return out.slice(0, limit);
-            }
-            """,
-            limit,
+    async def _extract_interactive_elements(self, limit: int = 50, viewport_only: bool = False):
+        elements = await self._call_page_helper(
+            "__extractInteractive",
+            _EXTRACT_INTERACTIVE_JS,
+            {"limit": limit, "viewportOnly": viewport_only},
         )
         return elements
 
-    async def _retrieve_relevant_elements(self, query: str, k: int = 5) -> Dict[str, Any]:
+    async def _take_screenshot(self, full_page: bool = False) -> bytes:
+        """Captures the page in memory (no path), Playwright returns the encoded bytes directly."""
+        if self.screenshot_type == "jpeg":
+            return await self.active_page.screenshot(full_page=full_page, type="jpeg", quality=self.screenshot_quality)
+        return await self.active_page.screenshot(full_page=full_page, type="png")
+
+    async def _collect_state_bundle(self, limit: int = 1000, viewport_only: bool = False) -> Dict[str, Any]:
+        """Returns url, interactive elements and scroll metrics with a single evaluate."""
+        cache = self._dom_cache
+        # viewport-only lists depend on the scroll position, which is not a DOM mutation
+        reuse = not viewport_only and cache is not None and cache[:2] == (self.active_page.url, limit)
+        bundle = await self._call_page_helper(
+            "__stateBundle",
+            _STATE_BUNDLE_JS,
+            {"limit": limit, "viewportOnly": viewport_only, "reuse": reuse},
+        )
+        if bundle["elements"] is None:
+            bundle["elements"] = cache[2]
+        elif not viewport_only:
+            self._dom_cache = (bundle["url"], limit, bundle["elements"])
+        return bundle
+
+    async def _retrieve_relevant_elements(
+        self, query: str, k: int = 5, viewport_only: bool = False, elements: Optional[List[str]] = None
+    ) -> Dict[str, Any]:
         """Tool that performs a semantic search over the current DOM.
 
         The agent can call this when it has a ``CURRENT TASK`` and wants to
         narrow the list of interactive elements to those that appear
         semantically relevant. ``query`` is usually the task description.
+        ``elements`` can be passed when they were already extracted from the page.
         """
         await self._ensure_started()
         start = time.time()
-        # pull the latest elements from the page
-        elements = await self._extract_interactive_elements(limit=1000)
+        if elements is None:
+            # pull the latest elements from the page
+            elements = await self._extract_interactive_elements(limit=1000, viewport_only=viewport_only)
         c1 = time.time()
         logging.info(f"DOM extraction got {len(elements)} elements in {c1 - start:.2f} seconds for query: \"{query}\"")
         if not query:
             return elements[:k]  # if no query, just return the first k elements
 
-        self._dom_retriever.build_index(elements)
+        # Embedding + FAISS are CPU-bound, keep them off the event loop
+        await asyncio.to_thread(self._dom_retriever.build_index, elements)
         c2 = time.time()
         logging.info(f"DOM index built with {len(elements)} elements for query: \"{query}\" in {c2 - c1:.2f} seconds")
-        results = self._dom_retriever.query(query, k)
+        results = await asyncio.to_thread(self._dom_retriever.query, query, k)
         c3 = time.time()
         logging.info(f"DOM retrieval for query: \"{query}\" returned {len(results)} results in {c3 - c2:.2f} seconds")
         return results
 
-    async def get_state(self, query: str = "", with_screenshot: bool = True, full_page_screenshot: bool = False) -> List[types.Part]:
+    async def get_state(
+        self,
+        query: str = "",
+        with_screenshot: bool = True,
+        full_page_screenshot: bool = False,
+        viewport_only: bool = False,
+        tool_context: Optional[ToolContext] = None,
+    ) -> List[types.Part]:
         """
         Returns the full observable state of the browser.
         ``query`` is an optional string that can be used to filter the DOM elements using the RAG tool before returning the state.
         ``with_screenshot`` controls whether to include a screenshot of the current page in the returned state.
         ``full_page_screenshot`` controls whether to take a full page screenshot or only a viewport screenshot.
+        ``viewport_only`` restricts the DOM elements to those currently inside the viewport.
 
         Includes:
         - Current page URL
@@ -190,28 +497,83 @@ class BrowserManager:
         - Structured list of interactive DOM elements from the current page, optionally filtered by relevance to the query.
         """
         await self._ensure_started()
-
+        # injected by ADK; without it there is no invocation to scope a dom_diff base to
+        invocation_id = tool_context.invocation_id if tool_context is not None else None
+
+        # Coalesce identical concurrent observations into a single capture. An action issued
+        # in between (possibly still queued on _page_lock) starts a new generation, so later
+        # calls observe after it instead of joining the earlier capture.
+        key = (self._action_generation, self.active_page.url, invocation_id, query, with_screenshot, full_page_screenshot, viewport_only)
+        inflight = self._inflight_states.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(
+                self._capture_state(query, with_screenshot, full_page_screenshot, viewport_only, invocation_id)
+            )
+            self._inflight_states[key] = inflight
+            inflight.add_done_callback(lambda _: self._inflight_states.pop(key, None))
+
+        state = await asyncio.shield(inflight)
+        return list(state)
+
+    async def _capture_state(
+        self,
+        query: str,
+        with_screenshot: bool,
+        full_page_screenshot: bool,
+        viewport_only: bool,
+        invocation_id: Optional[str] = None,
+    ) -> List[types.Part]:
         async with self._page_lock:
             try:
                 await self._wait_for_load_state()
 
-                #dom = await self._extract_interactive_elements(40) old version without rag
-                dom = await self._retrieve_relevant_elements(query=query, k=30)  # new version with RAG filtering
+                async def _screenshot():
+                    if not with_screenshot:
+                        return None
+                    return await self._take_screenshot(full_page=full_page_screenshot)
+
+                async def _observe_dom():
+                    # url, elements and scroll metrics come back from one evaluate
+                    bundle = await self._collect_state_bundle(limit=1000, viewport_only=viewport_only)
+                    #dom = await self._extract_interactive_elements(40) old version without rag
+                    dom = await self._retrieve_relevant_elements(query=query, k=30, elements=bundle["elements"])  # new version with RAG filtering
+                    return bundle, dom
+
+                # DOM observation and screenshot are independent round-trips, overlap them
+                (bundle, dom), image_bytes = await asyncio.gather(_observe_dom(), _screenshot())
+                metrics = bundle["metrics"]
                 logging.info(f"Retrieved {len(dom)} relevant DOM elements for state query: \"{query}\"")
 
-                # Get scroll metrics using the custom function _get_scroll_metrics
-                metrics = await self._get_scroll_metrics()
-
                 # Calculate the visible percentage of the page
                 visible_percentage = (metrics["viewportH"] / metrics["docH"]) * 100
                 scroll_position = metrics["scrollY"]
 
                 # Compact custom format to save tokens
-                lines = [f"url: {self.active_page.url}"]
+                lines = [f"url: {bundle['url']}"]
                 lines.append(f"visible_percentage: {visible_percentage:.2f}% of the page visible in the viewport.")
                 lines.append(f"scroll_position: {scroll_position} pixels down the page.")
                 
-                if dom:
+                last = self._last_observation
+                observed = (invocation_id, bundle["url"], query, viewport_only)
+                self._last_observation = (*observed, dom)
+                diff = None
+                # a new invocation starts without earlier history, it always gets the full list
+                if self.dom_diff and invocation_id is not None and last is not None and last[:4] == observed:
+                    diff = self._diff_elements(last[4], dom)
+
+                if diff is not None and dom:
+                    added, removed = diff
+                    if added or removed:
+                        lines.append(f"elements: unchanged since the previous state except for {len(added) + len(removed)}")
+                    else:
+                        lines.append("elements: unchanged since the previous state")
+                    if added:
+                        lines.append("elements_added:")
+                        lines.extend(added)
+                    if removed:
+                        lines.append("elements_removed:")
+                        lines.extend(removed)
+                elif dom:
                     lines.append("elements:")
                     lines.extend(dom)  # dom now contains pre-formatted strings
                 else:
@@ -224,22 +586,9 @@ class BrowserManager:
                 ]
 
                 # Screenshot part
-                if with_screenshot:
-                    if full_page_screenshot:
-                        # Take a full-page screenshot
-                        await self.active_page.screenshot(path="screenshot_full.jpg", full_page=True, type="jpeg", quality=60)
-                        screenshot_path = "screenshot_full.jpg"
-                    else:
-                        # Take only the visible viewport screenshot
-                        await self.active_page.screenshot(path="screenshot_viewport.jpg", full_page=False, type="jpeg", quality=60)
-                        screenshot_path = "screenshot_viewport.jpg"
-
-                    # Read the image file as bytes
-                    async with aiofiles.open(screenshot_path, "rb") as f:
-                        image_bytes = await f.read()
-
+                if image_bytes is not None:
                     # Append the screenshot to the state
-                    state.append(types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg"))
+                    state.append(types.Part.from_bytes(data=image_bytes, mime_type=f"image/{self.screenshot_type}"))
 
             except Exception as e:
                 logging.error(f"Error in get_state: {e}")
@@ -247,15 +596,31 @@ class BrowserManager:
         
         return state
 
-    async def goto_url(self, url: str):
-        """Navigates to the specified URL."""
+    @staticmethod
+    def _diff_elements(previous: List[str], current: List[str]) -> Optional[tuple]:
+        """Returns (added, removed) element lines, or None if the change is too large for a diff."""
+        previous_set, current_set = set(previous), set(current)
+        added = [e for e in current if e not in previous_set]
+        removed = [e for e in previous if e not in current_set]
+        if len(added) + len(removed) > _DOM_DIFF_THRESHOLD:
+            return None
+        return added, removed
+
+    async def goto_url(
+        self, url: str, wait_until: Literal["domcontentloaded", "load", "networkidle"] = "domcontentloaded"
+    ):
+        """Navigates to the specified URL.
+
+        ``wait_until`` is the load state awaited by the navigation itself; get_state settles the page again before observing.
+        """
         await self._ensure_started()
+        self._action_generation += 1  # before queuing on _page_lock, see get_state
         async with self._page_lock:
+            self._dom_cache = None
             if not url.startswith(("http://", "https://")):
                 url = "https://" + url
             try:
-                await self.active_page.goto(url, timeout=10000, wait_until="domcontentloaded")
-                await self._wait_for_load_state()
+                await self.active_page.goto(url, timeout=10000, wait_until=wait_until)
                 return {"status": "success", "url": self.active_page.url}
             except Exception as e:
                 return {"status": "error", "message": f"Error navigating to {url}: {str(e)}"}
@@ -266,24 +631,28 @@ class BrowserManager:
         if not text:
             return {"status": "error", "message": "mode='text' requires: text"}
 
-        for role in ["button", "link"]:
-            loc = self.active_page.get_by_role(role, name=text, exact=exact)
-            if await loc.count() > 0:
-                await loc.first.click(timeout=timeout_ms)
-                await self._wait_for_load_state()
-                clicked_text = await loc.first.inner_text()
-                return {"status": "success", "clicked_mode": "text", "role": role, "text": clicked_text, "url_after": self.active_page.url}
-
-        # fallback text locator
-        loc = self.active_page.get_by_text(text, exact=exact)
-        if await loc.count() == 0:
-            return {"status": "error", "message": f"No element found containing text: {text}"}
-
-        await loc.first.click(timeout=timeout_ms)
+        role_loc = self.active_page.get_by_role("button", name=text, exact=exact).or_(
+            self.active_page.get_by_role("link", name=text, exact=exact)
+        )
+        text_loc = self.active_page.get_by_text(text, exact=exact)
+        # independent probes, issued concurrently; a miss on both fails without waiting on a timeout
+        role_count, text_count = await asyncio.gather(role_loc.count(), text_loc.count())
+        if role_count:
+            # role hits are less ambiguous than raw text matches, prefer them
+            loc, fallback_role = role_loc.first, None
+        elif text_count:
+            loc, fallback_role = text_loc.first, "unknown"
+        else:
+            return {"status": "error", "message": f"No clickable element found containing text: {text}"}
+
+        # read before clicking, the element may be gone once the click navigates
+        clicked = await loc.evaluate(
+            "(el, fallback) => ({ text: el.innerText, role: el.getAttribute('role') || fallback || (el.tagName === 'A' ? 'link' : 'button') })",
+            fallback_role,
+        )
+        await loc.click(timeout=timeout_ms)
         await self._wait_for_load_state()
-        clicked_text = await loc.first.inner_text()
-        role = await loc.first.get_attribute("role") or "unknown"
-        return {"status": "success", "clicked_mode": "text", "role": role, "text": clicked_text, "url_after": self.active_page.url}
+        return {"status": "success", "clicked_mode": "text", "role": clicked["role"], "text": clicked["text"], "url_after": self.active_page.url}
 
     async def _click_by_selector(
         self, selector: Optional[str], timeout_ms: int
@@ -291,19 +660,42 @@ class BrowserManager:
         if not selector:
             return {"status": "error", "message": "mode='selector' requires: selector"}
 
+        # click directly instead of query_selector + click: one round-trip on the happy path
+        loc = self.active_page.locator(selector)
         try:
-            el = await self.active_page.query_selector(selector)
+            found = await self._run_locator_action(
+                loc, lambda timeout: loc.first.click(timeout=timeout), timeout_ms
+            )
+            if not found:
+                return {"status": "error", "message": f"No clickable element found for selector: {selector}"}
+        except PlaywrightTimeoutError:
+            raise  # the element exists but was not clickable, reported by click()
         except Exception as e:
             logging.error(f"Selector query failed: {selector}, error: {e}")
             return {"status": "error", "message": f"Selector query failed: {e}"}
-        
-        if not el:
-            return {"status": "error", "message": f"No element found for selector: {selector}"}
 
-        await el.click(timeout=timeout_ms)
         await self._wait_for_load_state()
         return {"status": "success", "clicked_mode": "selector", "selector": selector, "url_after": self.active_page.url}
 
+    async def _run_locator_action(self, loc, action, timeout_ms: int) -> bool:
+        """Runs ``action(timeout)`` against ``loc``, returns False if the locator matches nothing.
+
+        Covered, disabled or animating elements time out too, so a short first attempt is
+        followed by count(): only a missing match is reported as such, otherwise the action
+        is retried with the rest of the budget and a second timeout propagates.
+        """
+        first_ms = min(timeout_ms, _FIRST_ATTEMPT_MS)
+        try:
+            await action(first_ms)
+            return True
+        except PlaywrightTimeoutError:
+            if await loc.count() == 0:
+                return False
+            if timeout_ms <= first_ms:
+                raise
+        await action(timeout_ms - first_ms)
+        return True
+
     async def _click_by_coordinates(
         self, coordinates: Optional[str]
     ) -> Dict[str, Any]:
@@ -312,13 +704,11 @@ class BrowserManager:
         
         try:
             x, y = self._parse_point(coordinates)
+            if self.screenshot_scale < 1:
+                # the model reads coordinates off the downscaled screenshot
+                x, y = round(x / self.screenshot_scale), round(y / self.screenshot_scale)
             await self.active_page.mouse.click(x, y)
-            clicked_text = await self.active_page.evaluate("""
-                ({x, y}) => {
-                    const el = document.elementFromPoint(x, y);
-                    return el ? (el.innerText || el.textContent || "").slice(0, 100) : "";
-                }
-            """, {"x": x, "y": y})
+            clicked_text = await self.active_page.evaluate(_TEXT_AT_POINT_JS, {"x": x, "y": y})
         except Exception as e:
             logging.error(f"Coordinates click failed: {coordinates}, error: {e}")
             return {"status": "error", "message": f"Coordinates click failed: {e}"}
@@ -350,7 +740,9 @@ class BrowserManager:
         timeout_ms = 10000
 
         await self._ensure_started()
+        self._action_generation += 1  # before queuing on _page_lock, see get_state
         async with self._page_lock:
+            self._dom_cache = None
             await self._wait_for_load_state()
             try:
                 if mode == "text":
@@ -367,22 +759,34 @@ class BrowserManager:
             except PlaywrightTimeoutError as e:
                 return {"status": "error", "message": "Timeout during click", "mode": mode, "details": str(e)}
 
-    async def type(self, selector: str, content: str):
-        """Types into an input field safely."""
+    async def type(self, selector: str, content: str, simulate_keys: bool = False):
+        """Types into an input field safely.
+
+        ``simulate_keys`` types character by character with real key events,
+        use it only for widgets that react to each keystroke (e.g. search-as-you-type).
+        """
         await self._ensure_started()
+        self._action_generation += 1  # before queuing on _page_lock, see get_state
         async with self._page_lock:
+            self._dom_cache = None
             logging.info(f"Typing into selector: {selector} with content: {content}")
 
+            # fill resolves, scrolls into view, focuses, clears and sets the value in one call
+            loc = self.active_page.locator(selector)
+
+            async def _type(timeout):
+                if simulate_keys:
+                    await loc.first.fill("", timeout=timeout)
+                    await loc.first.press_sequentially(content, timeout=timeout)
+                else:
+                    await loc.first.fill(content, timeout=timeout)
+
             try:
-                el = await self.active_page.query_selector(selector)
-                if el:
-                    await el.scroll_into_view_if_needed()
-                    await el.focus()
-                    await el.fill("")
-                    await el.type(content)
-                    await self._wait_for_load_state()
-                if not el:
+                if not await self._run_locator_action(loc, _type, 10000):
                     return {"status": "error", "message": f"No element found for selector: {selector}"}
+            except PlaywrightTimeoutError as e:
+                # disabled, readonly or non-editable elements
+                return {"status": "error", "message": "Timeout while typing", "details": str(e)}
             except Exception as e:
                 logging.warning(f"Selector query failed: {selector}, error: {e}")
                 return {"status": "error", "message": f"Selector query failed: {e}"}
@@ -393,47 +797,20 @@ class BrowserManager:
         """
         Returns basic scroll metrics for the current page.
         """
-        metrics = await self.active_page.evaluate("""
-            () => {
-                const scrollY = window.scrollY || window.pageYOffset;
-                const viewportH = window.innerHeight;
-                const docH = Math.max(
-                    document.body.scrollHeight,
-                    document.documentElement.scrollHeight,
-                    document.body.offsetHeight,
-                    document.documentElement.offsetHeight,
-                    document.body.clientHeight,
-                    document.documentElement.clientHeight
-                );
-                return {
-                    scrollY,
-                    viewportH,
-                    docH,
-                    atBottom: scrollY + viewportH >= docH - 2  // small tolerance
-                };
-            }
-        """)
+        metrics = await self._call_page_helper("__scrollMetrics", _SCROLL_METRICS_JS)
         return metrics
 
-    async def scroll_percent(
-        self, percent: float, before: Dict[str, Any]
-    ) -> Dict[str, Any]:
+    async def scroll_percent(self, percent: float) -> Dict[str, Any]:
         if percent is None:
             return {"status": "error", "message": "percent required"}
-        target = int((before["docH"] - before["viewportH"]) * (percent / 100))
-        await self.active_page.evaluate(
-            """({top}) => window.scrollTo({ top, left: 0 })""", {"top": target}
-        )
-        return {"status": "success"}
+        metrics = await self.active_page.evaluate(_SCROLL_TO_SETTLED_JS, {"percent": percent, "y": None})
+        return {"status": "success", **metrics}
 
-    async def scroll_y(self, y: int, before: Dict[str, Any]) -> Dict[str, Any]:
+    async def scroll_y(self, y: int) -> Dict[str, Any]:
         if y is None:
             return {"status": "error", "message": "y required"}
-        target = max(0, min(y, before["docH"] - before["viewportH"]))
-        await self.active_page.evaluate(
-            """({top}) => window.scrollTo({ top, left: 0 })""", {"top": target}
-        )
-        return {"status": "success"}
+        metrics = await self.active_page.evaluate(_SCROLL_TO_SETTLED_JS, {"percent": None, "y": y})
+        return {"status": "success", **metrics}
 
     async def scroll_to_selector(self, selector: str) -> Dict[str, Any]:
         if not selector:
@@ -455,43 +832,21 @@ class BrowserManager:
     async def scroll_to_text(self, text: str) -> Dict[str, Any]:
         if not text:
             return {"status": "error", "message": "text required"}
-        needle = text.strip().lower()
-        found = await self.active_page.evaluate(
-            """(needle) => {
-                const elems = Array.from(document.querySelectorAll("h1,h2,h3,h4,h5,h6,a,button,p,li,section,div"));
-                for (const e of elems) {
-                    if ((e.innerText || "").toLowerCase().includes(needle)) {
-                        e.scrollIntoView({ block: "center" });
-                        return e.innerText.slice(0, 140);
-                    }
-                }
-                return null;
-            }""",
-            needle,
-        )
-        if not found:
+        needle = text.strip().lower()  # lowercased once here, not per node in the page
+        metrics = await self.active_page.evaluate(_SCROLL_TO_TEXT_SETTLED_JS, needle)
+        if not metrics:
             return {"status": "error", "message": f"Text not found: {text}"}
-        return {"status": "success"}
+        return {"status": "success", **metrics}
 
     async def scroll_step(
         self,
         direction: Literal["down", "up", "left", "right"],
         steps: int,
-        before: Dict[str, Any],
     ) -> Dict[str, Any]:
-        step_px = int(before["viewportH"] * 0.8)
-        dx = dy = 0
-        if direction == "down":
-            dy = step_px
-        elif direction == "up":
-            dy = -step_px
-        elif direction == "right":
-            dx = step_px
-        elif direction == "left":
-            dx = -step_px
-        for _ in range(max(1, steps)):
-            await self.active_page.evaluate("""({dx, dy}) => window.scrollBy(dx, dy)""", {"dx": dx, "dy": dy})
-        return {"status": "success"}
+        metrics = await self.active_page.evaluate(
+            _SCROLL_STEP_SETTLED_JS, {"direction": direction, "steps": max(1, steps)}
+        )
+        return {"status": "success", **metrics}
 
     async def scroll(
         self,
@@ -518,43 +873,44 @@ class BrowserManager:
         Returns metrics (before/after), and an anchor snippet for continuity.
         """
         await self._ensure_started()
+        self._action_generation += 1  # before queuing on _page_lock, see get_state
         async with self._page_lock:
-
-            async def _settle():
-                # small wait after scroll
-                await self.active_page.wait_for_timeout(300)
-
             try:
-                # get basic metrics
-                before = await self._get_scroll_metrics()
-
+                # percent/y/step/to_text read their own before/after metrics in the same round-trip
                 if mode == "percent":
-                    result = await self.scroll_percent(percent, before)
+                    result = await self.scroll_percent(percent)
                     if result["status"] == "error":
                         return result
+                    before, after = result["before"], result["after"]
 
                 elif mode == "y":
-                    result = await self.scroll_y(y, before)
+                    result = await self.scroll_y(y)
                     if result["status"] == "error":
                         return result
+                    before, after = result["before"], result["after"]
 
-                elif mode == "to_selector":
-                    result = await self.scroll_to_selector(selector)
+                elif mode == "to_text":
+                    result = await self.scroll_to_text(text)
                     if result["status"] == "error":
                         return result
+                    before, after = result["before"], result["after"]
 
-                elif mode == "to_text":
-                    result = await self.scroll_to_text(text)
+                elif mode == "to_selector":
+                    # get basic metrics
+                    before = await self._get_scroll_metrics()
+
+                    result = await self.scroll_to_selector(selector)
                     if result["status"] == "error":
                         return result
 
+                    # resolves on the next frame instead of a fixed 300 ms sleep
+                    after = await self.active_page.evaluate(_SETTLED_METRICS_JS)
+
                 else:  # step
-                    result = await self.scroll_step(direction, steps, before)
+                    result = await self.scroll_step(direction, steps)
                     if result["status"] == "error":
                         return result
-
-                await _settle()
-                after = await self._get_scroll_metrics()
+                    before, after = result["before"], result["after"]
 
                 return {
                     "status": "ok",
@@ -573,6 +929,8 @@ class BrowserManager:
         """Waits for a short period to allow the page to update."""
         await self._ensure_started()
         async with self._page_lock:
+            # the page is expected to change, including through CSS/resources the observer does not see
+            self._dom_cache = None
             await self.active_page.wait_for_timeout(ms)
             return {"status": "success", "waited_ms": ms}
         
@@ -594,16 +952,15 @@ class BrowserManager:
             A dict describing what was pressed.
         """
         await self._ensure_started()
+        self._action_generation += 1  # before queuing on _page_lock, see get_state
         async with self._page_lock:
+            self._dom_cache = None
             await self._wait_for_load_state()
 
             try:
-                def is_modifier(k: str) -> bool:
-                    return k in {"Control", "Shift", "Alt"}
-
                 if len(keys) == 1:
                     await self.active_page.keyboard.press(keys[0])
-                elif len(keys) > 1 and all(is_modifier(k) for k in keys[:-1]) and not is_modifier(keys[-1]):
+                elif len(keys) > 1 and all(k in _MODIFIER_KEYS for k in keys[:-1]) and keys[-1] not in _MODIFIER_KEYS:
                     # Handle combination like Control+A or Control+Shift+A
                     combo = "+".join(keys)
                     await self.active_page.keyboard.press(combo)
@@ -618,37 +975,81 @@ class BrowserManager:
             except Exception as e:
                 return {"status": "error", "message": f"Keyboard press failed: {str(e)}", "pressed_keys": keys}
 
+    async def _close_page(self):
+        """Closes the active page and its context, keeping the browser process alive."""
+        try:
+            if self.active_page:
+                try:
+                    await self.active_page.close()
+                except:
+                    pass
+            if self.context:
+                try:
+                    await self.context.close()
+                except:
+                    pass
+        finally:
+            self.context = None
+            self.active_page = None
+            self._dom_cache = None
+            self._last_observation = None
+            self._started = False
+
     async def close(self):
         """Closes the browser and cleans up resources."""
+        # Only the page and context are closed; the launched browser is reused by an init
+        # within keep_alive_s, otherwise it is shut down
         async with self._browser_lock:
             async with self._page_lock:
-                try:
-                    # Close in proper order: page -> context -> driver -> playwright
-                    if self.active_page:
-                        try:
-                            await self.active_page.close()
-                        except:
-                            pass
-                    if self.context:
-                        try:
-                            await self.context.close()
-                        except:
-                            pass
-                    if self.driver:
-                        try:
-                            await self.driver.close()
-                        except:
-                            pass
-                    if self.playwright:
-                        try:
-                            await self.playwright.stop()
-                        except:
-                            pass
-                finally:
-                    self.context = None
-                    self.driver = None
-                    self.playwright = None
-                    self.active_page = None
-                    self._started = False
-        
+                await self._close_page()
+            if self.keep_alive_s is not None and self.driver is not None:
+                if self._idle_shutdown is not None:
+                    self._idle_shutdown.cancel()
+                self._idle_shutdown = asyncio.get_running_loop().call_later(
+                    self.keep_alive_s, lambda: asyncio.ensure_future(self._shutdown_if_idle())
+                )
+
         return {"status": "success", "message": "Browser closed"}
+
+    async def _shutdown_if_idle(self):
+        async with self._browser_lock:
+            self._idle_shutdown = None
+            # a new session may have started while the timer was pending
+            if self._started:
+                return
+            async with self._page_lock:
+                await self._stop_browser()
+
+    async def shutdown(self):
+        """Stops the browser process and Playwright.
+
+        Runs on its own keep_alive_s after close(); call it directly on application
+        teardown, or when keep_alive_s is None.
+        """
+        async with self._browser_lock:
+            if self._idle_shutdown is not None:
+                self._idle_shutdown.cancel()
+                self._idle_shutdown = None
+            async with self._page_lock:
+                await self._stop_browser()
+
+        return {"status": "success", "message": "Browser shut down"}
+
+    async def _stop_browser(self):
+        try:
+            # Close in proper order: page -> context -> driver -> playwright
+            await self._close_page()
+            if self.driver:
+                try:
+                    # for a CDP-connected browser this only disconnects, the process keeps running
+                    await self.driver.close()
+                except:
+                    pass
+            if self.playwright:
+                try:
+                    await self.playwright.stop()
+                except:
+                    pass
+        finally:
+            self.driver = None
+            self.playwright = None
@@ -40,10 +40,11 @@ def inject_current_task(callback_context: CallbackContext, llm_request: LlmReque
     task_description = current.description if current else "NO TASK"
     injected_marker = "=== CURRENT TASK ==="
     original_instruction = llm_request.config.system_instruction
+    parts = getattr(original_instruction, "parts", None)
     if isinstance(original_instruction, str):
         text = original_instruction
-    elif original_instruction and hasattr(original_instruction, "parts"):
-        text = original_instruction.parts[0].text or ""
+    elif parts:
+        text = parts[0].text or ""
     else:
         text = ""
  
@@ -40,11 +40,8 @@ class SessionState(BaseModel):
 
 
 def _load_state(tool_context: ToolContext) -> SessionState:
-    raw_state = (
-        tool_context.state.to_dict()
-        if hasattr(tool_context.state, "to_dict")
-        else {}
-    )
+    to_dict = getattr(tool_context.state, "to_dict", None)
+    raw_state = to_dict() if to_dict else {}
     return SessionState(**raw_state)
 
 def _save_state(tool_context: ToolContext, state: SessionState):